@@ -1,9 +1,17 @@
-import os, time, json, sys, traceback, re
-import requests
+import os, time, sys, traceback, re, functools
+import orjson
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    import fcntl  # nur POSIX – unter Windows entfällt der Instanz-Lock
+except ImportError:
+    fcntl = None
+
 load_dotenv()
 
 # ====== ENV ======
@@ -25,8 +33,16 @@ FORWARDER_NOTIONAL = float(
 # Polling-Takt
 POLL_BASE   = int(os.getenv("POLL_BASE_SECONDS", "300"))   # 5 min
 POLL_OFFSET = int(os.getenv("POLL_OFFSET_SECONDS", "5"))   # +5 sec
+POLL_MAX    = int(os.getenv("POLL_MAX_SECONDS", "1800"))   # Obergrenze bei Idle-Backoff (30 min)
+IDLE_TICKS_CAP = 8  # ab hier wächst der Backoff nicht weiter
+
+# Optional: alle neuen Messages eines Ticks als ein Batch-POST pro Webhook
+BATCH_WEBHOOK = os.getenv("BATCH_WEBHOOK", "0").strip() == "1"
 
 STATE_FILE = Path("state.json")
+LOCK_FILE  = STATE_FILE.with_suffix(".json.lock")
+_lock_fh = None  # offen halten, solange der Prozess läuft
+_last_written_id = None  # zuletzt persistierte last_id (vermeidet redundante Writes)
 
 if not DISCORD_TOKEN or not CHANNEL_ID or not WEBHOOK_1:
     print("Bitte ENV Variablen setzen: DISCORD_TOKEN, CHANNEL_ID, WEBHOOK_1.")
@@ -37,49 +53,141 @@ HEADERS = {
     "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
                    "AppleWebKit/537.36 (KHTML, like Gecko) "
                    "Chrome/126.0 Safari/537.36"),
+    "X-RateLimit-Precision": "millisecond",
 }
 
+# Ein HTTP/2-Client für alle Requests (Keep-Alive + Multiplexing, HPACK-komprimierte Header).
+# HEADERS bewusst NICHT auf dem Client – sonst ginge der Discord-Token an die Webhooks.
+# follow_redirects wie bei requests: z. B. FastAPI /hook -> /hook/ (307 behält den POST-Body)
+CLIENT = httpx.Client(
+    http2=True,
+    follow_redirects=True,
+    timeout=15.0,
+    limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+)
+
+# Rate-Limit: frühester Zeitpunkt für den nächsten Discord-Request (aus X-RateLimit-*)
+_next_allowed_ts = 0.0
+
+# Webhook-POSTs parallel (WEBHOOK_1 + WEBHOOK_2 sind unabhängig)
+EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="webhook")
+
+# ====== Regex (einmalig kompiliert) ======
+_BLOCK_SPLIT = re.compile(r"\n\s*\n")
+_TF_RE       = re.compile(r"Timeframe:\s*([A-Za-z0-9]+)", re.I)
+# eigenständige TF-Zeile inkl. Zeilenumbruch (zum Herauslösen, ohne Nachbarzeilen anzufassen)
+_TF_LINE_RE  = re.compile(r"^[ \t]*Timeframe:[ \t]*[A-Za-z0-9]+[ \t]*(?:\n|$)", re.I | re.M)
+_TF_LITERAL  = "timeframe:"  # Vorab-Check für content/footer, wo meist kein TF steht
+
 # ====== Utils ======
 
+def acquire_instance_lock():
+    """
+    Verhindert, dass zwei Forwarder parallel laufen (doppeltes Polling -> 429-Eskalation).
+    Zweite Instanz beendet sich sofort.
+    """
+    global _lock_fh
+    if fcntl is None:
+        return
+    _lock_fh = open(LOCK_FILE, "w")
+    try:
+        fcntl.flock(_lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print(f"Forwarder läuft bereits (Lock: {LOCK_FILE}). Beende.")
+        sys.exit(1)
+
 def load_state():
+    """
+    last_id kommt als int zurück (einmalig konvertiert), gespeichert wird er als String.
+    """
+    global _last_written_id
+    state = {"last_id": None}
     if STATE_FILE.exists():
         try:
-            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
+            state = orjson.loads(STATE_FILE.read_bytes())
         except Exception:
             pass
-    return {"last_id": None}
+    raw = state.get("last_id")
+    _last_written_id = str(raw) if raw is not None else None
+    state["last_id"] = int(raw) if raw is not None else None
+    return state
 
 def save_state(state):
-    STATE_FILE.write_text(json.dumps(state), encoding="utf-8")
+    """
+    Schreibt state.json atomar (tmp + fsync + os.replace), aber nur wenn sich last_id geändert hat.
+    """
+    global _last_written_id
+    if state.get("last_id") == _last_written_id:
+        return
+    tmp = STATE_FILE.with_suffix(".json.tmp")
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, STATE_FILE)
+    _last_written_id = state.get("last_id")
+
+def _note_rate_limit(r):
+    """
+    Merkt sich aus X-RateLimit-Remaining/-Reset-After, wann der Bucket wieder frei ist.
+    """
+    global _next_allowed_ts
+    remaining = r.headers.get("X-RateLimit-Remaining")
+    reset_after = r.headers.get("X-RateLimit-Reset-After")
+    if remaining == "0" and reset_after:
+        try:
+            _next_allowed_ts = time.time() + float(reset_after)
+        except ValueError:
+            pass
+
+def _discord_get(url):
+    wait = _next_allowed_ts - time.time()
+    if wait > 0:
+        time.sleep(wait)
+    r = CLIENT.get(url, headers=HEADERS)
+    _note_rate_limit(r)
+    return r
 
-def fetch_latest_messages(channel_id, limit=5):
-    url = f"https://discord.com/api/v9/channels/{channel_id}/messages?limit={limit}"
-    r = requests.get(url, headers=HEADERS, timeout=15)
+def fetch_latest_messages(channel_id, after=None, limit=5):
+    """
+    Mit `after` nur die wirklich neuen Messages (max. 50 pro Tick),
+    ohne `after` (erster Start) die letzten `limit` Messages als Backfill.
+    """
+    if after:
+        url = f"https://discord.com/api/v9/channels/{channel_id}/messages?after={after}&limit=50"
+    else:
+        url = f"https://discord.com/api/v9/channels/{channel_id}/messages?limit={limit}"
+    r = _discord_get(url)
     if r.status_code == 429:
-        retry = 5
+        # Sicherheitsnetz – sollte dank X-RateLimit-* kaum noch vorkommen
+        retry = 5.0
         try:
-            retry = r.json().get("retry_after", 5)
-        except Exception:
+            retry = float(r.headers.get("Retry-After", retry))
+        except ValueError:
             pass
         time.sleep(retry + 1)
-        r = requests.get(url, headers=HEADERS, timeout=15)
+        r = _discord_get(url)
     r.raise_for_status()
-    data = r.json()
-    data_sorted = sorted(data, key=lambda m: int(m["id"]))  # älteste zuerst
-    return data_sorted
+    data = orjson.loads(r.content)
+    for m in data:
+        m["_id_int"] = int(m["id"])  # Snowflake einmalig parsen
+    data.sort(key=itemgetter("_id_int"))  # älteste zuerst (in-place, frisch geparste Liste)
+    return data
 
 def _first_block(text: str) -> str:
     """
     Nimmt nur den ersten Signal-Block. Trennkriterium: 1+ Leerzeile(n).
     """
-    parts = re.split(r"\n\s*\n", text.strip())
+    parts = _BLOCK_SPLIT.split(text.strip())
     return parts[0].strip() if parts else text.strip()
 
 def _extract_timeframe_line(t: str) -> str | None:
     """
     Liefert die KOMPLETTE TF-Zeile ('Timeframe: XYZ'), falls vorhanden.
     """
-    m = re.search(r"Timeframe:\s*([A-Za-z0-9]+)", t, re.I)
+    if _TF_LITERAL not in t.lower():
+        return None
+    m = _TF_RE.search(t)
     return m.group(0).strip() if m else None
 
 def build_signal_text_from_msg(msg: dict) -> str:
@@ -87,30 +195,55 @@ def build_signal_text_from_msg(msg: dict) -> str:
     Baut den finalen Signaltext für den Trading-Server:
       - priorisiert embed.description (erster Block), sonst content (erster Block)
       - hängt die 'Timeframe: XYZ'-Zeile ans Ende, falls nicht bereits im Block vorhanden
-      - garantiert: am Ende genau EINE Timeframe-Zeile (wenn überhaupt vorhanden)
+      - garantiert: am Ende genau EINE eigenständige Timeframe-Zeile (wenn überhaupt vorhanden);
+        steht TF mitten in einer Zeile, bleibt diese Zeile unverändert
+    Ergebnis wird nach Inhalt (content, desc, footer) gecacht – hilft nur, wenn derselbe
+    Text mehrfach gebaut wird (z. B. identische Signale oder Aufruf außerhalb von main).
     """
     content = (msg.get("content") or "").strip()
     embeds  = msg.get("embeds") or []
 
-    desc = ""
-    footer_tf_line = None
-
+    # Nur embeds[0] wird ausgewertet -> als hashbares (desc, footer_text)-Tupel
+    embeds_tuple = ()
     if embeds and isinstance(embeds, list):
         e0 = embeds[0] or {}
         desc = (e0.get("description") or "").strip()
         # footer kann als dict kommen
         footer = e0.get("footer") or {}
         footer_txt = (footer.get("text") or "").strip() if isinstance(footer, dict) else ""
-        if footer_txt:
-            footer_tf_line = _extract_timeframe_line(footer_txt)
+        embeds_tuple = (desc, footer_txt)
+
+    # Fast-Path: kein Text (z. B. nur Attachment) -> gar keine Regex-Arbeit
+    if not content and not (embeds_tuple and embeds_tuple[0]):
+        return ""
+
+    return _build_signal_text_impl(content, embeds_tuple)
+
+@functools.lru_cache(maxsize=256)
+def _build_signal_text_impl(content: str, embeds_tuple: tuple) -> str:
+    desc, footer_txt = embeds_tuple if embeds_tuple else ("", "")
+    footer_tf_line = _extract_timeframe_line(footer_txt) if footer_txt else None
 
     # Basistext = erster Block aus embed.description, sonst content
     base_text = _first_block(desc if desc else content)
 
-    # Hat der Base-Block schon eine TF-Zeile?
-    tf_inline = _extract_timeframe_line(base_text)
+    # Hat der Base-Block schon eine TF-Zeile? (Regex direkt – bei echten Signalen der Normalfall)
+    line_m = _TF_LINE_RE.search(base_text)
+    m = None if line_m else _TF_RE.search(base_text)
 
-    if not tf_inline:
+    if line_m:
+        # Eigenständige TF-Zeile(n) herauslösen und die erste als LETZTE Zeile anhängen
+        tf_inline = line_m.group(0).strip()
+        block_ohne_tf = _TF_LINE_RE.sub("", base_text).rstrip()
+        final_text = block_ohne_tf + "\n" + tf_inline
+    elif m:
+        # TF steht mitten in einer Signal-Zeile -> Zeile nicht umbauen, TF zusätzlich ans Ende
+        tf_inline = m.group(0).strip()
+        block = base_text.rstrip()
+        if not block[m.end():].strip():
+            block = block[:m.start()].rstrip()  # TF am Blockende: abtrennen statt doppeln
+        final_text = block + "\n" + tf_inline
+    else:
         # Versuche TF aus content oder footer zu holen
         tf_from_content = _extract_timeframe_line(content) if content else None
         tf_line = tf_from_content or footer_tf_line
@@ -118,18 +251,37 @@ def build_signal_text_from_msg(msg: dict) -> str:
             final_text = base_text.rstrip() + "\n" + tf_line
         else:
             final_text = base_text  # ggf. filtert der Server dann raus
-    else:
-        # Stelle sicher, dass TF als LETZTE Zeile steht (doppelte TF vermeiden)
-        block_ohne_tf = re.sub(r"\n?Timeframe:\s*[A-Za-z0-9]+\s*$", "", base_text, flags=re.I).rstrip()
-        final_text = block_ohne_tf + "\n" + tf_inline
 
     return final_text.strip()
 
-def forward_to_webhooks(msg):
+def _post_one(client, url, payload, idx, label):
+    """
+    Ein einzelner Webhook-POST (läuft im EXECUTOR).
+    """
+    try:
+        r = client.post(url, content=orjson.dumps(payload),
+                        headers={"Content-Type": "application/json"}, timeout=20)
+        r.raise_for_status()
+        print(f"[→ Webhook{idx}] OK | {label} | notional={FORWARDER_NOTIONAL}")
+    except Exception as ex:
+        print(f"[→ Webhook{idx}] FAIL: {ex}")
+
+def _post_to_all(payload, label):
+    """
+    Schickt denselben Payload parallel an WEBHOOK_1 (+ WEBHOOK_2).
+    """
+    urls = [WEBHOOK_1] + ([WEBHOOK_2] if WEBHOOK_2 else [])
+    futs = [EXECUTOR.submit(_post_one, CLIENT, url, payload, idx, label)
+            for idx, url in enumerate(urls, start=1)]
+    for f in as_completed(futs):
+        f.result()
+
+def forward_to_webhooks(msg, text=None):
     """
     Sendet genau { "text": "...Signal...", "notional": <FORWARDER_NOTIONAL> }.
+    `text` kann vorab gebaut übergeben werden (sonst aus msg gebaut).
     """
-    text = build_signal_text_from_msg(msg)
+    text = text if text is not None else build_signal_text_from_msg(msg)
     if not text:
         print("[skip] Keine verwertbare Message (leer).")
         return
@@ -138,71 +290,91 @@ def forward_to_webhooks(msg):
         "text": text,
         "notional": FORWARDER_NOTIONAL
     }
+    _post_to_all(payload, f"text[:80]={text[:80]!r}")
 
-    urls = [WEBHOOK_1] + ([WEBHOOK_2] if WEBHOOK_2 else [])
-    for idx, url in enumerate(urls, start=1):
-        try:
-            r = requests.post(url, json=payload, timeout=20)
-            r.raise_for_status()
-            print(f"[→ Webhook{idx}] OK | text[:80]={text[:80]!r} | notional={FORWARDER_NOTIONAL}")
-        except Exception as ex:
-            print(f"[→ Webhook{idx}] FAIL: {ex}")
+def forward_batch_to_webhooks(msgs, texts=None):
+    """
+    Sendet alle neuen Messages eines Ticks in EINEM POST pro Webhook:
+    { "batch": [ { "text": "...", "notional": <FORWARDER_NOTIONAL> }, ... ] }
+    (nur mit BATCH_WEBHOOK=1 – der Empfänger muss das Batch-Format kennen)
+    """
+    if texts is None:
+        texts = [build_signal_text_from_msg(m) for m in msgs]
+    batch = []
+    for text in texts:  # älteste zuerst
+        if text:
+            batch.append({"text": text, "notional": FORWARDER_NOTIONAL})
+    if not batch:
+        print("[skip] Keine verwertbaren Messages im Batch (leer).")
+        return
+
+    _post_to_all({"batch": batch}, f"batch={len(batch)} Signal(e)")
 
-def sleep_until_next_tick():
+def sleep_until_next_tick(multiplier=1):
     """
-    Schläft exakt bis zum nächsten (n*POLL_BASE + POLL_OFFSET)-Zeitpunkt,
-    basierend auf Unix-Zeit (Serverzeit).
+    Schläft exakt bis zum nächsten (n*period + POLL_OFFSET)-Zeitpunkt,
+    basierend auf Unix-Zeit (Serverzeit). period = POLL_BASE * multiplier,
+    gedeckelt auf POLL_MAX und immer ein Vielfaches von POLL_BASE (Raster bleibt gleich).
     """
+    period = max(POLL_BASE, min(POLL_BASE * multiplier, POLL_MAX) // POLL_BASE * POLL_BASE)
     now = time.time()
-    period_start = (now // POLL_BASE) * POLL_BASE
-    next_tick = period_start + POLL_BASE + POLL_OFFSET
-    if now < period_start + POLL_OFFSET:
-        next_tick = period_start + POLL_OFFSET
-    sleep_s = max(0, next_tick - now)
-    time.sleep(sleep_s)
+    now_i = int(now)
+    delta = POLL_OFFSET - now_i % period  # ganzzahlig: Sekunden bis zum Offset dieser Periode
+    if delta <= 0:
+        delta += period
+    # Sub-Sekunden-Anteil abziehen; nie negativ schlafen (z. B. nach NTP-Sprung)
+    time.sleep(max(0.0, delta - (now - now_i)))
 
 # ====== Main Loop ======
 
 def main():
+    acquire_instance_lock()
     print(f"Getaktet: alle {POLL_BASE}s, jeweils +{POLL_OFFSET}s Offset (z. B. 10:00:05, 10:05:05, …)")
     print(f"➡️  Forwarder-Notional (pro Trade, ohne Hebel): {FORWARDER_NOTIONAL}")
+    if BATCH_WEBHOOK:
+        print("➡️  Batch-Modus aktiv: ein POST pro Webhook und Tick")
     state = load_state()
     last_id = state.get("last_id")
+    idle_ticks = 0  # aufeinanderfolgende Ticks ohne neue Messages
 
     # Auf ersten exakten Tick ausrichten
     sleep_until_next_tick()
 
     while True:
         try:
-            msgs = fetch_latest_messages(CHANNEL_ID, limit=5)
-            new_msgs = []
-            for m in msgs:
-                mid = m.get("id")
-                if last_id is None or int(mid) > int(last_id):
-                    new_msgs.append(m)
+            # liefert dank ?after=<last_id> nur neue Messages (älteste zuerst)
+            new_msgs = fetch_latest_messages(CHANNEL_ID, after=last_id)
 
             if new_msgs:
-                for m in new_msgs:  # älteste zuerst
-                    forward_to_webhooks(m)
-                last_id = new_msgs[-1]["id"]
-                state["last_id"] = last_id
+                idle_ticks = 0
+                # Signaltext genau einmal pro Message bauen
+                texts = [build_signal_text_from_msg(m) for m in new_msgs]
+                if BATCH_WEBHOOK:
+                    forward_batch_to_webhooks(new_msgs, texts)
+                else:
+                    for m, text in zip(new_msgs, texts):  # älteste zuerst
+                        forward_to_webhooks(m, text)
+                last_id = new_msgs[-1]["_id_int"]
+                state["last_id"] = str(last_id)
                 save_state(state)
                 ts = datetime.now().strftime("%H:%M:%S")
                 print(f"[{ts}] {len(new_msgs)} neue Nachricht(en) verarbeitet. last_id={last_id}")
             else:
+                idle_ticks = min(idle_ticks + 1, IDLE_TICKS_CAP)
                 ts = datetime.now().strftime("%H:%M:%S")
                 print(f"[{ts}] Keine neuen Nachrichten.")
 
         except KeyboardInterrupt:
             print("\nStopped.")
             break
-        except requests.HTTPError as http_err:
+        except httpx.HTTPStatusError as http_err:
             print("[HTTP ERROR]", http_err.response.status_code, http_err.response.text[:200])
         except Exception:
             print("[ERROR]")
             traceback.print_exc()
 
-        sleep_until_next_tick()
+        # Idle-Backoff: alle 2 leeren Ticks Intervall verdoppeln (bis POLL_MAX)
+        sleep_until_next_tick(multiplier=1 << (idle_ticks // 2))
 
 if __name__ == "__main__":
     main()